@@ -0,0 +1,302 @@
+#! /usr/bin/env python
+
+import warnings
+
+warnings.simplefilter("ignore")
+
+import matplotlib
+matplotlib.use('Agg')                                                     # Benchmarks never need a display
+
+import numpy as np
+import multiprocessing as mp
+import resource
+import tempfile
+import time
+import os
+import sys
+import json
+import pickle
+import PlotObjects as po
+import StatObjects as so
+
+
+baseline_file=os.path.join(os.path.dirname(os.path.abspath(__file__)),'benchmark_baseline.json')
+
+def synthetic_lightcurve(n_samples,binning=0.0625,seed=0):               # ===Noisy light curve with a drifting QPO===
+   rng=np.random.RandomState(seed)
+   times=np.arange(n_samples)*binning
+   freq=0.1+0.05*times/times[-1]                                          #    Drifts from 0.10 to 0.15 Hz over the run
+   rate=100+20*np.sin(2*np.pi*np.cumsum(freq)*binning)
+   counts=rng.poisson(rate)
+   return times,counts,np.sqrt(np.maximum(counts,1))
+
+def synthetic_scatter(n_points,seed=0):                                   # ===Correlated x,y scatter===
+   rng=np.random.RandomState(seed)
+   x=rng.randn(n_points)
+   return [x,0.5*x+rng.randn(n_points)]
+
+def synthetic_spectrogram_chart(n_windows,n_freqs,seed=0):                # ===lightcurve_ls with a ready-made random spectrogram===
+   rng=np.random.RandomState(seed)
+   times=np.arange(n_windows+2)*1.0
+   chart=po.lightcurve_ls(times,np.ones(len(times)),np.ones(len(times)))
+   chart.freqs=np.linspace(0.01,0.4,n_freqs)
+   chart.taxis=times[:n_windows]
+   chart.spectrogram=rng.rand(n_freqs,n_windows)
+   chart.lcurve=100+10*rng.randn(n_windows)
+   chart.maxfreqs=chart.freqs[rng.randint(0,n_freqs,n_windows)]
+   chart.show_max_freqs()
+   chart.is_plotted=True
+   return chart
+
+def synthetic_density_chart(n_points,resolution,seed=0):                  # ===Binned density_chart of correlated random points===
+   rng=np.random.RandomState(seed)
+   x=rng.randn(n_points)
+   chart=po.density_chart([x,0.5*x+rng.randn(n_points)])
+   chart.set_densitymap_resolution(resolution)
+   chart.plot()
+   return chart
+
+def reference_lomb_scargle(times,counts,errors,freqs):                   # ===Lomb-Scargle by explicit weighted least squares===
+
+   # An independent check on lomb_scargle_batch: at each frequency an offset plus a sinusoid is fitted by weighted least
+   # squares, and the power is the fractional drop in chi^2 from a constant fit (Zechmeister & Kurster 2009, eq. 4).
+
+   times=np.asarray(times,dtype=float)
+   counts=np.asarray(counts,dtype=float)
+   root_w=1.0/np.asarray(errors,dtype=float)
+   mean=np.sum(root_w**2*counts)/np.sum(root_w**2)
+   chi2_0=np.sum((root_w*(counts-mean))**2)
+   power=np.empty(len(freqs))
+   for i,freq in enumerate(freqs):
+      arg=2*np.pi*freq*times
+      design=np.array([np.ones(len(times)),np.cos(arg),np.sin(arg)]).transpose()
+      fit=np.linalg.lstsq(design*root_w[:,np.newaxis],counts*root_w,rcond=-1)[0]
+      chi2=np.sum((root_w*(counts-design.dot(fit)))**2)
+      power[i]=(chi2_0-chi2)/chi2_0
+   return power
+
+def check_lomb_scargle(n_windows=20,win_size=300,tolerance=1e-9,seed=0):  # ===Check the batch engine against the reference===
+   rng=np.random.RandomState(seed)
+   freqs=np.arange(0.01,0.4,0.001)
+   times=np.sort(rng.uniform(0,60,(n_windows,win_size)),axis=1)+1000*rng.rand(n_windows,1) # Uneven sampling, offset starts
+   counts=100+20*np.sin(2*np.pi*rng.uniform(0.05,0.3,(n_windows,1))*times)+5*rng.randn(n_windows,win_size)
+   errors=rng.uniform(2,8,(n_windows,win_size))                           #    Unequal errors exercise the weighting
+   batch=po.lomb_scargle_batch(times,counts,errors,freqs,max_elements=5*win_size*len(freqs)) # Several chunks
+   worst=0.0
+   for i in range(n_windows):
+      reference=reference_lomb_scargle(times[i],counts[i],errors[i],freqs)
+      assert np.array_equal(po.lomb_scargle(times[i],counts[i],errors[i],freqs),batch[i])
+      worst=max(worst,np.abs(batch[i]-reference).max())
+      assert np.argmax(batch[i])==np.argmax(reference)
+   print 'lomb_scargle_batch %d windows, max difference from least squares reference %.1e'%(n_windows,worst)
+   assert worst<tolerance,'lomb_scargle_batch differs from the reference by %.1e'%worst
+   return worst
+
+def check_sliding(n_samples=2000,win_size=200,steps=(1,20,70,199,250),refreshes=(1,5,64),tolerance=1e-9): # ===Check the incremental path===
+   times,counts,errors=synthetic_lightcurve(n_samples)                    #    Against lomb_scargle_batch on the same windows, for
+   freqs=np.arange(0.01,0.4,0.001)                                        #     overlapping and non-overlapping steps
+   worst=0.0
+   for step in steps:
+      batch=po.lomb_scargle_batch(po.window_view(times,win_size,step),po.window_view(counts,win_size,step),
+                                  po.window_view(errors,win_size,step),freqs)
+      for refresh in refreshes:
+         sliding=po.lomb_scargle_sliding(times,counts,errors,freqs,win_size,step,refresh=refresh)
+         assert sliding.shape==batch.shape
+         assert np.array_equal(np.argmax(sliding,axis=1),np.argmax(batch,axis=1)),'maxfreqs differ at step %d, refresh %d'%(step,refresh)
+         worst=max(worst,np.abs(sliding-batch).max())
+   print 'lomb_scargle_sliding %d step/refresh pairs, max difference from batch %.1e'%(len(steps)*len(refreshes),worst)
+   assert worst<tolerance,'lomb_scargle_sliding differs from lomb_scargle_batch by %.1e'%worst
+   return worst
+
+def render_case(kind,size,renderer,decimate,fmt):                         # ===Render and save one chart, measuring time and memory===
+   if kind=='spectrogram':
+      chart=synthetic_spectrogram_chart(*size)
+   else:
+      chart=synthetic_density_chart(*size)
+   chart.set_renderer(renderer)
+   chart.set_decimate(decimate)
+   handle,filename=tempfile.mkstemp(suffix='.'+fmt)
+   os.close(handle)
+   rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss                 #    Peak RSS before drawing (kB on Linux)
+   start=time.time()
+   chart.make_plot()
+   chart.fig.savefig(filename)
+   elapsed=time.time()-start
+   peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-rss
+   nbytes=os.path.getsize(filename)
+   os.remove(filename)
+   return elapsed,peak/1024.0,nbytes/1024.0
+
+def isolated_target(queue,func,args):                                     # ===Child side of run_isolated===
+   try:
+      queue.put((True,func(*args)))
+   except Exception as error:
+      queue.put((False,error))
+
+def run_isolated(func,*args):                                             # ===Run func in a fresh process so peak memory is its own===
+   queue=mp.Queue()
+   process=mp.Process(target=isolated_target,args=(queue,func,args))     #    Not a pool worker, so func may start its own pool
+   process.start()
+   ok,result=queue.get()
+   process.join()
+   if not ok:
+      raise result
+   return result
+
+class collect_stages():                                                   # ===Progress callback keeping every finished stage===
+
+   def __init__(self):
+      self.stages={}
+
+   def __call__(self,info):
+      if info['finished']:
+         self.stages.setdefault(info['stage'],[]).append(info)
+
+   def summary(self):                                                     # ===Fastest run, best rate and peak memory of each stage===
+      result={}
+      for name,runs in self.stages.items():
+         rates=[run['rate'] for run in runs if run['rate'] is not None]
+         result[name]={'elapsed':min(run['elapsed'] for run in runs),'rate':max(rates) if rates else None,
+                       'peak_mb':max(run['peak_mb'] for run in runs)}
+      return result
+
+def engine_case(kind,size,repeats=5):                                     # ===Run one engine on synthetic data, collecting stage timings===
+   collector=collect_stages()
+   handle,filename=tempfile.mkstemp(suffix='.png')
+   os.close(handle)
+   if kind in ('lightcurve','incremental'):
+      chart=po.lightcurve_ls(*synthetic_lightcurve(size))
+      chart.set_incremental(kind=='incremental')
+   elif kind=='density':
+      chart=po.density_chart(synthetic_scatter(size))
+      chart.set_densitymap_resolution(0.005)
+   else:
+      chart=so.statrange(synthetic_scatter(size)[1])
+   chart.set_progress(collector)
+   if kind=='statrange':
+      for i in range(repeats):                                            #    Queries are quick, so keep the fastest of several
+         chart.percentiles([5,95])
+         chart.percentiles(np.arange(0,101,10))
+      assert np.allclose(chart.percentiles([1,50,99]),np.percentile(chart.data,[1,50,99]))
+   else:
+      chart.set_renderer('image')
+      chart.plot()
+   chart.save(filename)
+   os.remove(filename)
+   return collector.summary()
+
+def bench_engines(sizes=None):                                            # ===Time each engine's stages at several data sizes===
+   if sizes is None:
+      sizes={'lightcurve':[4000,16000],'incremental':[4000,16000,64000],
+             'density':[10**4,10**5,10**6],'statrange':[10**4,10**5,10**6]}
+   results={}
+   for kind in ('lightcurve','incremental','density','statrange'):
+      for size in sizes.get(kind,[]):
+         stages=run_isolated(engine_case,kind,size)                       #    Fresh process each, so peak memory is the case's own
+         for name in sorted(stages):
+            info=stages[name]
+            rate='%12.0f /s'%info['rate'] if info['rate'] else ' '*15
+            print '%-12s %8d %-12s %8.3f s %s %8.1f MB peak'%(kind,size,name,info['elapsed'],rate,info['peak_mb'])
+            results['%s %d %s'%(kind,size,name)]=info
+   return results
+
+def check_regressions(results,filename=baseline_file,tolerance=1.5,floor=0.01,update=False): # ===Compare timings with a saved baseline===
+
+   # A stage has regressed if it takes more than tolerance times its baseline time plus floor seconds, the floor keeping
+   # timer noise on very quick stages from counting.  Timings depend on the machine, so the baseline is kept locally (it is
+   # git-ignored) and recorded with update=True, or 'python Benchmarks.py --update-baseline'.  Without one the check fails.
+
+   if update:
+      with open(filename,'w') as baseline:
+         json.dump(results,baseline,indent=1,sort_keys=True)
+      print 'Baseline written to',filename
+      return []
+   assert os.path.exists(filename),'No benchmark baseline at %s: record one with --update-baseline'%filename
+   with open(filename) as baseline:
+      baseline=json.load(baseline)
+   regressions=[]
+   for name in sorted(results):
+      if name not in baseline:
+         print 'NO BASELINE %-35s %8.3f s'%(name,results[name]['elapsed'])
+      elif results[name]['elapsed']>tolerance*baseline[name]['elapsed']+floor:
+         regressions.append(name)
+         print 'REGRESSION %-36s %8.3f s against %8.3f s'%(name,results[name]['elapsed'],baseline[name]['elapsed'])
+   assert not regressions,'%d stages slower than baseline'%len(regressions)
+   return regressions
+
+def bench_render(n_windows=2000,n_freqs=400,n_points=100000,resolution=0.002,fmt='png'): # ===Compare renderers===
+   cases=[('pcolor',False),('mesh',False),('image',False),('image',True)]
+   results={}
+   for kind,size in (('spectrogram',(n_windows,n_freqs)),('density',(n_points,resolution))):
+      for renderer,decimate in cases:
+         if kind=='density' and decimate:
+            continue
+         elapsed,peak,nbytes=run_isolated(render_case,kind,size,renderer,decimate,fmt)
+         label=renderer+('+decimate' if decimate else '')
+         results[(kind,label)]=(elapsed,peak,nbytes)
+         print '%-12s %-16s %8.2f s %9.1f MB peak %9.1f kB %s'%(kind,label,elapsed,peak,nbytes,fmt)
+   return results
+
+def batch_memory_case(n_charts,workers):                                  # ===Peak RSS after each quarter of a render_batch run===
+   directory=tempfile.mkdtemp()
+   peaks=[]
+   kept=[]                                                                #    Every chart stays alive, so a figure held by any of
+   for quarter in range(4):                                               #     them shows up as growth; the charts alone are small
+      filenames=[os.path.join(directory,'chart%d.png'%i) for i in range(n_charts//4)]
+      charts=[synthetic_density_chart(1000,0.02,seed=len(kept)+i) for i in range(len(filenames))]
+      for chart in charts:
+         chart.set_renderer('image')
+      po.render_batch(charts,filenames,workers=workers)
+      kept.extend(charts)
+      peaks.append(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0)
+      for filename in filenames:
+         os.remove(filename)
+   os.rmdir(directory)
+   return peaks
+
+def bench_batch_memory(n_charts=120,workers=1,tolerance=20.0):            # ===Check that batch rendering memory stays flat===
+   start=time.time()
+   peaks=run_isolated(batch_memory_case,n_charts,workers)
+   growth=peaks[-1]-peaks[0]                                              #    Anything leaked per chart shows up as growth
+   print 'render_batch     %d charts %8.2f s  peak RSS by quarter %s MB, growth %.1f MB'%(n_charts,time.time()-start,
+                                                                                       ['%.1f'%peak for peak in peaks],growth)
+   assert growth<tolerance,'render_batch memory grew by %.1f MB over %d charts'%(growth,n_charts)
+   return peaks
+
+def batch_pool_case(n_points):                                            # ===render_batch on pools with charts that need computing===
+   import pylab as pl
+   directory=tempfile.mkdtemp()
+   lightcurve=po.lightcurve_ls(*synthetic_lightcurve(3000))               #    Unplotted, asking for its own pool of workers
+   lightcurve.set_workers(2)
+   rng=np.random.RandomState(0)
+   columns=[os.path.join(directory,name+'.npy') for name in 'xy']
+   for column in columns:
+      np.save(column,rng.randn(n_points))
+   density=po.density_chart.from_files(*columns)                          #    Memory-mapped, so must not be copied to the workers
+   filenames=[os.path.join(directory,'chart%d.png'%i) for i in range(3)]
+   po.render_batch([lightcurve,density],filenames[:2],workers=2)
+   shipped=len(pickle.dumps(density,2))
+   pl.switch_backend('svg')                                               #    Not Agg, with a figure open, so workers=1 falls back
+   figure=pl.figure()                                                     #     to a single pool worker
+   lightcurve.is_plotted=False
+   po.render_batch([lightcurve],filenames[2:],workers=1)
+   kept=pl.fignum_exists(figure.number)
+   for filename in filenames+columns:
+      os.remove(filename)
+   os.rmdir(directory)
+   return shipped,kept
+
+def check_batch_pool(n_points=2*10**6):                                   # ===Check render_batch's pools take unplotted charts===
+   shipped,kept=run_isolated(batch_pool_case,n_points)
+   print 'render_batch pools: %d point density_chart pickled to %.1f MB, caller figure kept %s'%(n_points,shipped/2.0**20,kept)
+   assert shipped<n_points,'density_chart columns were pickled (%.1f MB)'%(shipped/2.0**20)
+   assert kept,'render_batch closed the caller\'s figure'
+
+
+if __name__=='__main__':
+   check_lomb_scargle()
+   check_sliding()
+   check_regressions(bench_engines(),update='--update-baseline' in sys.argv)
+   bench_render()
+   bench_batch_memory()
+   check_batch_pool()
@@ -4,15 +4,461 @@ import warnings
 
 warnings.simplefilter("ignore")
 
-import scipy.stats as st
 import numpy as np
-import pylab as pl
-import matplotlib.gridspec as gridspec
-import random
-import matplotlib.patches as mpatches
-import imp
+import multiprocessing as mp
+import hashlib
+import os
+import Timing
+
+pl=None                                                                   # Plotting modules are only imported when a chart is first
+gridspec=None                                                             #  drawn (see load_plotting), so compute-only processes
+mpatches=None                                                             #  never pay for matplotlib
+
+def load_plotting():                                                      # ===Import the plotting modules on first use===
+   global pl,gridspec,mpatches
+   if pl is None:
+      import pylab
+      import matplotlib.gridspec
+      import matplotlib.patches
+      pl,gridspec,mpatches=pylab,matplotlib.gridspec,matplotlib.patches
+
+
+def window_view(array,win_size,step=1):                                   # ===Zero-copy 2D view of sliding windows===
+   array=np.ascontiguousarray(array,dtype=float)                          #    Windows start at 0,step,2*step... up to (but not including)
+   n_win=max(len(array)-win_size,0)                                       #     len(array)-win_size, exactly as in lightcurve_ls.plot
+   view=np.lib.stride_tricks.as_strided(array,shape=(n_win,win_size),strides=(array.strides[0],array.strides[0]))
+   return view[::step]
+
+def gls_power(sw,swy,swyy,swc,sws,swyc,swys,swcc,swss,swcs):              # ===Normalised power from weighted sums===
+
+   # All inputs are sums over a window of weight (w), weight*counts (wy), weight*counts^2 (wyy) and weight times the cos
+   # and sin terms at each frequency.  Only sums are needed, so windows can be built from scratch or updated incrementally.
+
+   sw=np.asarray(sw,dtype=float)[...,np.newaxis]                          #    Per-window totals broadcast along the frequency axis
+   Y=np.asarray(swy)[...,np.newaxis]/sw
+   YY=np.asarray(swyy)[...,np.newaxis]/sw-Y*Y
+   C=swc/sw
+   S=sws/sw
+   YC=swyc/sw-Y*C
+   YS=swys/sw-Y*S
+   CC=swcc/sw-C*C
+   SS=swss/sw-S*S
+   CS=swcs/sw-C*S
+   num=SS*YC*YC+CC*YS*YS-2*CS*YC*YS
+   den=YY*(CC*SS-CS*CS)
+   with np.errstate(divide='ignore',invalid='ignore'):
+      power=np.where(den>0,num/np.where(den>0,den,1),0.0)                 #    Flat windows and degenerate frequencies have zero power
+   return power
+
+def window_sums(t,y,w,omega):                                             # ===Weighted sums needed by gls_power===
+   arg=t[:,:,np.newaxis]*omega                                            #    (window,sample,frequency) phases
+   c=np.cos(arg)
+   s=np.sin(arg)
+   del arg
+   wy=w*y
+   return (w.sum(1),wy.sum(1),(wy*y).sum(1),
+           np.einsum('ij,ijk->ik',w,c),np.einsum('ij,ijk->ik',w,s),
+           np.einsum('ij,ijk->ik',wy,c),np.einsum('ij,ijk->ik',wy,s),
+           np.einsum('ij,ijk,ijk->ik',w,c,c),np.einsum('ij,ijk,ijk->ik',w,s,s),
+           np.einsum('ij,ijk,ijk->ik',w,c,s))
+
+def lomb_scargle(times,counts,errors,freqs):                              # ===Error-weighted Lomb-Scargle of a single window===
+   return lomb_scargle_batch([times],[counts],[errors],freqs)[0]
+
+periodograms={'native':lomb_scargle}                                      # Registered periodogram(times,counts,errors,freqs) functions
+
+def register_periodogram(name,function):                                  # ===Make a periodogram available to lightcurve_ls by name===
+   assert name!='native','The built-in periodogram cannot be replaced'    #    Cached spectrograms are keyed on the name, so give a
+   periodograms[name]=function                                            #     changed function a new one
+
+def load_pan(filename=None):                                              # ===Register PANTHEON's pan_lib.lomb_scargle as 'pan'===
+   if filename is None:
+      import pan_lib as pan                                               #    pan_lib must then be importable from sys.path
+   else:
+      import imp
+      pan=imp.load_source('pan_lib',filename)
+   register_periodogram('pan',pan.lomb_scargle)
+   return pan
+
+def periodogram_loop(periodogram,times,counts,errors,freqs,progress=None): # ===Spectrogram from a one-window-at-a-time periodogram===
+   n_win=len(times)
+   power=np.empty((n_win,len(freqs)))
+   for i in range(n_win):
+      power[i]=periodogram(times[i],counts[i],errors[i],freqs)
+      if progress is not None:
+         progress(i+1,n_win)
+   return power
+
+def lomb_scargle_batch(times,counts,errors,freqs,max_elements=2**20,progress=None): # ===Lomb-Scargle of a 2D batch of windows===
+
+   # Generalised (floating mean) Lomb-Scargle with weights 1/error^2.  times, counts and errors are 2D, one row per window,
+   # and the returned array has one row per window and one column per frequency.  Windows are processed in chunks of at most
+   # max_elements (window length * frequencies) trig evaluations so that memory stays bounded however many windows there are.
+   # progress, if given, is called as progress(windows_done,total_windows) after each chunk.
+
+   times=np.atleast_2d(times)                                             #    Accept lists or (strided) arrays without copying them whole
+   counts=np.atleast_2d(counts)
+   errors=np.atleast_2d(errors)
+   omega=2*np.pi*np.asarray(freqs,dtype=float)
+   n_win,win_len=times.shape
+   power=np.empty((n_win,len(omega)))
+   chunk=max(1,int(max_elements//max(win_len*len(omega),1)))              #    Number of windows per chunk
+   for c0 in range(0,n_win,chunk):
+      t=np.array(times[c0:c0+chunk],dtype=float)
+      t-=t[:,:1]                                                          #    Power is invariant to a time shift; this keeps the phases precise
+      y=np.array(counts[c0:c0+chunk],dtype=float)
+      w=1.0/np.array(errors[c0:c0+chunk],dtype=float)**2
+      power[c0:c0+chunk]=gls_power(*window_sums(t,y,w,omega))
+      if progress is not None:
+         progress(min(c0+chunk,n_win),n_win)
+   return power
+
+def sliding_segment(step,n_freqs,refresh=64,max_elements=2**20):         # ===Windows between full recomputes in lomb_scargle_sliding===
+   return max(1,min(refresh,int(max_elements//max(2*step*n_freqs,1))))    #    Also bounds the entering/leaving trig arrays
+
+def lomb_scargle_sliding(times,counts,errors,freqs,win_size,step,refresh=64,max_elements=2**20,progress=None): # ===Incremental sliding-window Lomb-Scargle===
+
+   # Gives the same result as lomb_scargle_batch on window_view(...,win_size,step), but builds each window's sums from the
+   # previous window's by subtracting the step samples that leave and adding the step samples that enter.  This costs
+   # O(step*frequencies) per window instead of O(win_size*frequencies).  The running sums are recomputed from scratch every
+   # refresh windows to stop floating-point drift from building up.
+
+   times=np.asarray(times,dtype=float)
+   counts=np.asarray(counts,dtype=float)
+   errors=np.asarray(errors,dtype=float)
+   if step>=win_size:                                                     #    Windows don't overlap, so there is nothing to reuse
+      return lomb_scargle_batch(window_view(times,win_size,step),window_view(counts,win_size,step),
+                                window_view(errors,win_size,step),freqs,max_elements=max_elements,progress=progress)
+   omega=2*np.pi*np.asarray(freqs,dtype=float)
+   weights=1.0/errors**2
+   starts=np.arange(0,max(len(times)-win_size,0),step)
+   n_win=len(starts)
+   power=np.empty((n_win,len(omega)))
+   seg=sliding_segment(step,len(omega),refresh,max_elements)
+   offsets=np.arange(step)
+   for k0 in range(0,n_win,seg):
+      k1=min(k0+seg,n_win)
+      t_ref=times[starts[k0]]                                             #    Common time origin for every window in this segment
+      idx=(starts[k0]+np.arange(win_size))[np.newaxis]                    #    First window of the segment is done from scratch
+      sums=window_sums(times[idx]-t_ref,counts[idx],weights[idx],omega)
+      if k1-k0>1:
+         enter=(starts[k0+1:k1]+win_size-step)[:,np.newaxis]+offsets      #    Samples entering and leaving at each slide
+         leave=(starts[k0+1:k1]-step)[:,np.newaxis]+offsets
+         s_in=window_sums(times[enter]-t_ref,counts[enter],weights[enter],omega)
+         s_out=window_sums(times[leave]-t_ref,counts[leave],weights[leave],omega)
+         sums=[np.concatenate([s0,si-so]).cumsum(axis=0) for s0,si,so in zip(sums,s_in,s_out)] # Running sums
+      power[k0:k1]=gls_power(*sums)
+      if progress is not None:
+         progress(k1,n_win)
+   return power
+
+shared_arrays={}                                                          #    Worker-side views of the data shared by lomb_scargle_parallel
+
+def init_shared(times,counts,errors):                                     # ===Pool initialiser: attach the shared data===
+   shared_arrays['times']=np.frombuffer(times)                            #    RawArrays are inherited by the workers, not pickled per task
+   shared_arrays['counts']=np.frombuffer(counts)
+   shared_arrays['errors']=np.frombuffer(errors)
+
+def spectrogram_chunk(task):                                              # ===Spectrogram of one run of windows (pool task)===
+   i0,i1,freqs,win_size,step,incremental,refresh=task                     #    Samples i0:i1 hold exactly the windows of this run
+   times=shared_arrays['times'][i0:i1]
+   counts=shared_arrays['counts'][i0:i1]
+   errors=shared_arrays['errors'][i0:i1]
+   if incremental:
+      return lomb_scargle_sliding(times,counts,errors,freqs,win_size,step,refresh=refresh)
+   return lomb_scargle_batch(window_view(times,win_size,step),window_view(counts,win_size,step),
+                             window_view(errors,win_size,step),freqs)
+
+def lomb_scargle_parallel(times,counts,errors,freqs,win_size,step,workers,incremental=False,refresh=64,progress=None): # ===Multi-process sliding-window Lomb-Scargle===
+
+   # Splits the window start indices into contiguous runs and computes them in a pool of workers processes.  The data are
+   # copied once into shared memory rather than pickled for every task, and the runs are collected in order, so the result
+   # is identical to the serial lomb_scargle_batch/lomb_scargle_sliding output.  progress is called in this process.
+
+   times=np.asarray(times,dtype=float)
+   counts=np.asarray(counts,dtype=float)
+   errors=np.asarray(errors,dtype=float)
+   starts=np.arange(0,max(len(times)-win_size,0),step)
+   n_win=len(starts)
+   if workers<=1 or n_win<2:                                              #    Not worth starting a pool
+      if incremental:
+         return lomb_scargle_sliding(times,counts,errors,freqs,win_size,step,refresh=refresh,progress=progress)
+      return lomb_scargle_batch(window_view(times,win_size,step),window_view(counts,win_size,step),
+                                window_view(errors,win_size,step),freqs,progress=progress)
+   bounds=np.linspace(0,n_win,min(n_win,4*workers)+1).astype(int) # A few runs per worker to balance the load
+   if incremental and step<win_size:
+      seg=sliding_segment(step,len(freqs),refresh)                        #    Line runs up with the full recomputes of the serial path
+      bounds=np.unique(np.append((bounds//seg)*seg,n_win))
+   runs=list(zip(bounds[:-1],bounds[1:]))
+   tasks=[(starts[k0],starts[k1-1]+win_size+1,freqs,win_size,step,incremental,refresh) for k0,k1 in runs]
+   shared=[]
+   for array in (times,counts,errors):
+      raw=mp.RawArray('d',len(array))
+      np.frombuffer(raw)[:]=array
+      shared.append(raw)
+   power=np.empty((n_win,len(freqs)))
+   pool=mp.Pool(workers,initializer=init_shared,initargs=shared)
+   try:
+      for (k0,k1),chunk in zip(runs,pool.imap(spectrogram_chunk,tasks)): # imap returns the runs in submission order
+         power[k0:k1]=chunk
+         if progress is not None:
+            progress(k1,n_win)
+   finally:
+      pool.terminate()
+      pool.join()
+   return power
+
+class spectrogram_cache():                                                # ===On-disk store of computed spectrograms===
+
+   '''Spectrogram Cache.
+
+   Stores spectrograms as uncompressed .npz files in a directory, keyed on a hash of the data and the window/frequency
+   settings.  Once the directory grows beyond max_bytes the least recently used entries are deleted.
 
-pan = imp.load_source('pan_lib.py', '/home/jamie/Documents/Data/Data_Management/PANTHEON/pan_lib.py')
+   Available actions:
+
+    cache.key(times,counts,errors,win_size,time_stp_size,freqs,periodogram='native')
+    cache.load(key)
+    cache.store(key,**arrays)
+    cache.evict()
+
+   '''
+
+   def __init__(self,directory,max_bytes=2**30):
+      self.directory=directory
+      self.max_bytes=max_bytes
+      if not os.path.isdir(directory):
+         os.makedirs(directory)
+
+   def key(self,times,counts,errors,win_size,time_stp_size,freqs,periodogram='native'): # ===Hash the inputs that determine a spectrogram===
+      h=hashlib.sha1()
+      h.update(repr((len(times),int(win_size),int(time_stp_size),len(freqs),periodogram)).encode())
+      for array in (times,counts,errors,freqs):
+         h.update(np.ascontiguousarray(array,dtype=float).tobytes())
+      return h.hexdigest()
+
+   def filename(self,key):
+      return os.path.join(self.directory,key+'.npz')
+
+   def load(self,key):                                                    # ===Fetch a cached entry as a dict, or None===
+      filename=self.filename(key)
+      try:
+         with np.load(filename) as entry:
+            arrays=dict((name,entry[name]) for name in entry.files)
+      except (IOError,OSError,ValueError):                                #    Missing or half-written entries count as misses
+         return None
+      try:
+         os.utime(filename,None)                                          #    Mark as recently used
+      except OSError:                                                     #    Evicted by another process since loading, which the
+         pass                                                             #     arrays already in hand don't care about
+      return arrays
+
+   def store(self,key,**arrays):                                          # ===Save an entry, then trim the cache===
+      tmpname=os.path.join(self.directory,key+'.%d.tmp.npz'%os.getpid())
+      np.savez(tmpname,**arrays)
+      os.rename(tmpname,self.filename(key))                               #    Atomic, so readers never see a partial file
+      self.evict()
+
+   def evict(self):                                                       # ===Delete least recently used entries until under max_bytes===
+      entries=[]
+      for name in os.listdir(self.directory):
+         if name.endswith('.npz') and not name.endswith('.tmp.npz'):
+            try:
+               info=os.stat(os.path.join(self.directory,name))
+            except OSError:
+               continue
+            entries.append((info.st_mtime,info.st_size,name))
+      entries.sort()
+      total=sum(entry[1] for entry in entries)
+      for mtime,size,name in entries:
+         if total<=self.max_bytes:
+            break
+         try:
+            os.remove(os.path.join(self.directory,name))
+         except OSError:
+            pass
+         total-=size
+
+def open_column(filename,dtype='float64'):                                # ===Memory-map one column of data from disk===
+   if filename.endswith('.npy'):                                          #    .npy files carry their own dtype and shape
+      return np.load(filename,mmap_mode='r')
+   return np.memmap(filename,dtype=dtype,mode='r')                        #    Anything else is read as a flat binary array
+
+def column_limits(values,chunk_size=2**20):                               # ===Min and max of a column, read in bounded-size chunks===
+   low=high=None
+   for i in range(0,len(values),chunk_size):
+      chunk=np.asarray(values[i:i+chunk_size])
+      if low is None:
+         low,high=chunk.min(),chunk.max()
+      else:
+         low,high=min(low,chunk.min()),max(high,chunk.max())
+   return low,high
+
+def lagged_pearson(x,y,shifts):                                           # ===Pearson coefficient of x against y at many integer shifts===
+
+   # For a shift k>0 x[k:] is paired with y[:-k], and for k<0 x[:k] with y[-k:], as in lightcurve_ls.show_Inu.  The sums of
+   # x, y, x^2 and y^2 over each overlap come from running sums, and the sums of x*y for every shift at once from a single
+   # FFT cross-correlation, so the whole scan costs O(n log n) rather than O(n) per shift.
+
+   x=np.asarray(x,dtype=float)
+   y=np.asarray(y,dtype=float)
+   shifts=np.asarray(shifts,dtype=int)
+   n=len(x)
+   x=x-x.mean()                                                           #    Centring keeps the sums well conditioned
+   y=y-y.mean()
+   size=int(2**np.ceil(np.log2(max(2*n,2))))
+   xcorr=np.fft.irfft(np.fft.rfft(x,size)*np.conj(np.fft.rfft(y,size)),size) # xcorr[k]=sum x[i+k]*y[i], negative k wrap round
+   cx=np.concatenate([[0.0],np.cumsum(x)])
+   cy=np.concatenate([[0.0],np.cumsum(y)])
+   cxx=np.concatenate([[0.0],np.cumsum(x*x)])
+   cyy=np.concatenate([[0.0],np.cumsum(y*y)])
+   x0=np.maximum(shifts,0)                                                #    Overlapping ranges x[x0:x0+m] and y[y0:y0+m]
+   y0=np.maximum(-shifts,0)
+   m=n-np.abs(shifts)
+   sx=cx[x0+m]-cx[x0]
+   sy=cy[y0+m]-cy[y0]
+   sxx=cxx[x0+m]-cxx[x0]-sx*sx/m
+   syy=cyy[y0+m]-cyy[y0]-sy*sy/m
+   sxy=xcorr[shifts%size]-sx*sy/m
+   with np.errstate(divide='ignore',invalid='ignore'):
+      return sxy/np.sqrt(sxx*syy)
+
+def gaussian_smooth(grid,sigmas):                                         # ===Convolve a binned grid with a Gaussian kernel via FFT===
+
+   # sigmas gives the kernel width, in bins, along each axis of grid.  The kernel is separable, so each axis is convolved in
+   # turn with a zero-padded real FFT, costing O(G log G) for G bins regardless of how many points went into the grid.
+
+   grid=np.asarray(grid,dtype=float)
+   for axis,sigma in enumerate(sigmas):
+      if sigma<=0:
+         continue
+      n=grid.shape[axis]
+      half=int(min(np.ceil(4*sigma),n))                                   #    Truncate the kernel at 4 sigma
+      kernel=np.exp(-0.5*(np.arange(-half,half+1)/float(sigma))**2)
+      kernel/=kernel.sum()
+      size=n+2*half                                                       #    Padding so the convolution doesn't wrap around
+      shape=[1]*grid.ndim
+      shape[axis]=size//2+1
+      spectrum=np.fft.rfft(grid,size,axis=axis)*np.fft.rfft(kernel,size).reshape(shape)
+      grid=np.take(np.fft.irfft(spectrum,size,axis=axis),np.arange(half,half+n),axis=axis)
+   return np.maximum(grid,0)                                              #    Remove tiny negative values left by rounding
+
+def centre_edges(centres):                                                # ===Cell edges for cells centred on the given values===
+   centres=np.asarray(centres,dtype=float)
+   if len(centres)<2:
+      return np.array([centres[0]-0.5,centres[0]+0.5])
+   mids=(centres[1:]+centres[:-1])/2
+   return np.concatenate([[2*centres[0]-mids[0]],mids,[2*centres[-1]-mids[-1]]])
+
+def draw_map(ax,grid,renderer,cmap,x_edges,y_edges):                      # ===Draw a 2D map with the chosen renderer===
+
+   # Every renderer draws the cells between x_edges and y_edges, so changing renderer never moves the map.  'pcolor' is the
+   # original output, one patch per cell; 'mesh' draws every cell as a single QuadMesh, and 'image' draws a raster with
+   # imshow, which is much the fastest to draw and save but needs evenly spaced edges, so it falls back to 'mesh'.
+
+   if renderer=='pcolor':
+      return ax.pcolor(x_edges,y_edges,grid,cmap=cmap)
+   if renderer=='image' and np.allclose(np.diff(x_edges),x_edges[1]-x_edges[0]) and np.allclose(np.diff(y_edges),y_edges[1]-y_edges[0]):
+      return ax.imshow(grid,cmap=cmap,origin='lower',aspect='auto',interpolation='nearest',
+                       extent=[x_edges[0],x_edges[-1],y_edges[0],y_edges[-1]])
+   return ax.pcolormesh(x_edges,y_edges,grid,cmap=cmap)
+
+def decimate(x,y,n_bins):                                                 # ===Thin a line to the min and max of each of n_bins buckets===
+   if n_bins<1 or len(x)<=2*n_bins:                                       #    Already no more than two points per bucket
+      return x,y
+   size=int(np.ceil(len(y)/float(n_bins)))
+   n_bins=int(np.ceil(len(y)/float(size)))
+   padded=np.full(n_bins*size,np.nan)
+   padded[:len(y)]=y
+   padded=padded.reshape(n_bins,size)
+   start=np.arange(n_bins)*size
+   idx=np.unique(np.concatenate([start+np.nanargmin(padded,axis=1),start+np.nanargmax(padded,axis=1)])) # Keeps time order
+   return x[idx],y[idx]
+
+def bin_points(x,y,xlims,ylims,pixelwidth,pixelheight,weights=None):      # ===2D counts of points on a pixel grid===
+   grid_x=(x-xlims[0])*pixelwidth/float(xlims[1]-xlims[0])                #    Fetch the pixel that corresponds with each datapoint
+   grid_y=(y-ylims[0])*pixelheight/float(ylims[1]-ylims[0])
+   valid=(grid_x>-1)&(grid_x<pixelwidth)&(grid_y>-1)&(grid_y<pixelheight) # Points that truncate to a valid pixel
+   pixel=grid_y[valid].astype(int)*pixelwidth+grid_x[valid].astype(int) # astype(int) truncates like int()
+   if weights is not None:
+      weights=weights[valid]
+   return np.bincount(pixel,weights=weights,minlength=pixelwidth*pixelheight).reshape(pixelheight,pixelwidth)
+
+def overlap_matrix(edges_from,edges_to):                                  # ===Fraction of each source bin that falls in each target bin===
+   low=np.maximum(edges_from[:-1,np.newaxis],edges_to[np.newaxis,:-1])
+   high=np.minimum(edges_from[1:,np.newaxis],edges_to[np.newaxis,1:])
+   return np.clip(high-low,0,None)/np.diff(edges_from)[:,np.newaxis]
+
+class density_pyramid():                                                  # ===Multi-resolution store of binned points===
+
+   '''Density Pyramid.
+
+   Holds a fine base_size x base_size histogram of points over fixed limits, plus coarser copies made by summing 2x2 blocks.
+   A densitymap at any limits and resolution is then rebuilt from the cells rather than the points, so the cost depends on
+   the size of the grid and not on the number of points.  rebin picks the coarsest level whose cells are at most
+   1/oversample of a target pixel and shares each cell's count between pixels in proportion to their overlap, which treats
+   points as spread evenly within a cell.  Zooming in past the base resolution blurs the map, so choose base_size to suit.
+
+   Available actions:
+
+    pyramid.add(x,y)
+    pyramid.clear()
+    pyramid.level(k)
+    pyramid.rebin(xlims,ylims,pixelwidth,pixelheight,hist_bins)
+
+   '''
+
+   def __init__(self,xlims,ylims,base_size=1024):
+      self.xlims=[float(xlims[0]),float(xlims[1])]
+      self.ylims=[float(ylims[0]),float(ylims[1])]
+      self.base_size=int(2**np.ceil(np.log2(base_size)))                  #    Power of two, so every level halves cleanly
+      self.clear()
+
+   def clear(self):                                                       # ===Remove all points===
+      self.levels=[np.zeros([self.base_size,self.base_size])]
+      self.count=0
+
+   def add(self,x,y):                                                     # ===Bin a chunk of points into the base level===
+      x=np.asarray(x,dtype=float)
+      y=np.asarray(y,dtype=float)
+      edge_x=x==self.xlims[1]                                             #    Keep points on the upper limits in the last cell
+      edge_y=y==self.ylims[1]
+      x=np.where(edge_x,self.xlims[0]+(self.xlims[1]-self.xlims[0])*(1-0.5/self.base_size),x)
+      y=np.where(edge_y,self.ylims[0]+(self.ylims[1]-self.ylims[0])*(1-0.5/self.base_size),y)
+      self.levels=[self.levels[0]+bin_points(x,y,self.xlims,self.ylims,self.base_size,self.base_size)] # Coarser levels are now stale
+      self.count+=len(x)
+
+   def level(self,k):                                                     # ===Level k, with base_size/2**k cells per side===
+      while len(self.levels)<=k:
+         n=len(self.levels[-1])//2
+         self.levels.append(self.levels[-1].reshape(n,2,n,2).sum(axis=(1,3)))
+      return self.levels[k]
+
+   def rebin(self,xlims,ylims,pixelwidth,pixelheight,hist_bins,oversample=4): # ===Densitymap and histograms at new limits/resolution===
+      x_diff=float(xlims[1]-xlims[0])
+      y_diff=float(ylims[1]-ylims[0])
+      px=min(x_diff/pixelwidth,x_diff/hist_bins)                          #    Smallest pixel that has to be resolved on each axis
+      py=min(y_diff/pixelheight,y_diff/hist_bins)
+      k=0
+      while (2**(k+1)<=self.base_size and (self.xlims[1]-self.xlims[0])*2**(k+1)/self.base_size<=px/oversample
+             and (self.ylims[1]-self.ylims[0])*2**(k+1)/self.base_size<=py/oversample):
+         k+=1                                                             #    Coarsest level that is still fine enough
+      cells=self.level(k)
+      n=len(cells)
+      x_edges=np.linspace(self.xlims[0],self.xlims[1],n+1)                #    Cell edges
+      y_edges=np.linspace(self.ylims[0],self.ylims[1],n+1)
+      i0,i1=np.clip(np.searchsorted(x_edges,[xlims[0]-x_diff/pixelwidth,xlims[1]])+[-1,1],0,n) # Only visit the cells inside
+      j0,j1=np.clip(np.searchsorted(y_edges,[ylims[0]-y_diff/pixelheight,ylims[1]])+[-1,1],0,n) #  the new limits
+      map_x=xlims[0]+np.arange(pixelwidth+1)*x_diff/pixelwidth            #    Pixel edges.  Binning truncates towards zero, so the first
+      map_y=ylims[0]+np.arange(pixelheight+1)*y_diff/pixelheight          #     pixel also collects points up to one pixel below
+      map_x[0]-=x_diff/pixelwidth                                         #     the lower limit
+      map_y[0]-=y_diff/pixelheight
+      wx=overlap_matrix(x_edges[i0:i1+1],map_x)
+      wy=overlap_matrix(y_edges[j0:j1+1],map_y)
+      density_map=wy.T.dot(cells[j0:j1,i0:i1]).dot(wx)                    #    Share each cell between pixels by overlap
+      x_hist=cells[:,i0:i1].sum(axis=0).dot(overlap_matrix(x_edges[i0:i1+1],np.linspace(xlims[0],xlims[1],hist_bins+1)))
+      y_hist=cells[j0:j1].sum(axis=1).dot(overlap_matrix(y_edges[j0:j1+1],np.linspace(ylims[0],ylims[1],hist_bins+1)))
+      return density_map,x_hist,y_hist
       
 
 class chart():
@@ -33,6 +479,10 @@ class chart():
       self.xlims=[0,1]
       self.ylims=[0,1]
       self.colormap='cool'                                                # Fetch name of colormap (so it can be changed by user if needs be)
+      self.renderer='pcolor'                                              # How maps are drawn: 'pcolor', 'mesh' or 'image'
+      self.decimate=False                                                 # Thin line overlays to the width of the figure
+      self.progress=None                                                  # Optional callback for stage timings (see Timing.stage)
+      self.timings={}                                                     # Wall time of the latest run of each stage
                         
    def set_xlabel(self,xlabel):                                           # ===Setter for xlabel===
       self.xlabel=xlabel
@@ -46,6 +496,19 @@ class chart():
    def set_colormap(self,colormap):                                       # ===Set colormap for the densitymap===
       self.colormap=colormap
 
+   def set_renderer(self,renderer):                                       # ===Set how maps are drawn===
+      assert renderer in ('pcolor','mesh','image')
+      self.renderer=renderer
+
+   def set_decimate(self,decimate=True):                                  # ===Toggle thinning of line overlays===
+      self.decimate=decimate
+
+   def set_progress(self,callback):                                       # ===Report stage timings to callback(info), or None for silence===
+      self.progress=callback                                              #    e.g. Timing.print_progress()
+
+   def stage(self,name,total=None,unit='windows'):                        # ===Start timing a stage of plot/make_plot/save===
+      return Timing.stage(name,self.progress,self.timings,total,unit)
+
    def show(self):                                                        # ===Display the plot===
       if self.is_plotted:
          self.make_plot()
@@ -54,13 +517,17 @@ class chart():
          self.make_plot()
       self.fig.show()
 
-   def save(self,savename):                                               # ===Display the plot===
+   def save(self,savename):                                               # ===Save the plot===
       if self.is_plotted:
          self.make_plot()
       else:
          self.plot()
          self.make_plot()
+      timer=self.stage('save')                                            #    Most of the drawing happens here, not in make_plot
       self.fig.savefig(savename)
+      pl.close(self.fig)                                                  #    Release the figure, so repeated saves don't pile up,
+      self.fig=None                                                       #     and drop the chart's own reference to it
+      timer.finish()
 
 
 
@@ -71,24 +538,34 @@ class density_chart(chart):                                               # ===T
 
    Available actions:
 
-    chart.set_densitymap_resolution(x)
+    density_chart(data,xlims=None,ylims=None)
+    density_chart.from_files(x,y,dtype='float64',xlims=None,ylims=None)
+    chart.set_densitymap_resolution(x,y=None)
     chart.set_histogram_resolution(x)
     chart.set_colormap(x)
+    chart.set_renderer(x)
+    chart.set_decimate(x)
+    chart.set_progress(x)
     chart.set_xlimit(x,y)
     chart.set_ylimit(x,y)
     chart.set_xlabel(x)
     chart.set_ylabel(x)
     chart.show_pearson()
     chart.hide_pearson()
+    chart.show_smoothed(bandwidth='scott')
+    chart.use_pyramid(base_size=1024)
+    chart.hide_smoothed()
     chart.plot()
+    chart.add_data(x,y)
     chart.show()
     chart.save()
 
    '''
 
-   def __init__(self,data):                                               # Must provide two dimensional data to the object.  This can consist of a
+   def __init__(self,data,xlims=None,ylims=None):                         # Must provide two dimensional data to the object.  This can consist of a
                                                                           #  tuple containing the list of x-values in element zero and the identical
-                                                                          #  length list of y-values in element one.
+                                                                          #  length list of y-values in element one.  Limits default to the data
+                                                                          #  range, so must be given if the data are empty and streamed in later.
 
       self.startup()                                                      # Basic initialisation
       if len(data)!=2:
@@ -99,39 +576,73 @@ class density_chart(chart):                                               # ===T
       self.xvalues=data[0]                                                # Extract x-values
       self.yvalues=data[1]                                                # Extract y-values
       self.dens_res=1                                                     # Set up dummy variables to be filled later
+      self.dens_res_y=None                                                # y-resolution follows the x-resolution unless set separately
       self.hist_res=1
       self.num_data=len(data[0])                                          # Fetch number of data points
       self.contour=False
+      self.smoothed=False                                                 #    Show raw counts unless smoothing is requested
+      self.pyramid=None                                                   #    Bin straight from the data unless a pyramid is requested
+      self.bandwidth='scott'
 
       assert len(data[0])==len(data[1])
 
-      self.set_xlimit(min(self.xvalues),max(self.xvalues))                # Set the limits to a default value (the max and min values on each axis)
-      self.set_ylimit(min(self.yvalues),max(self.yvalues))
+      if xlims is None:
+         xlims=column_limits(self.xvalues)                                # Set the limits to a default value (the max and min values on each axis)
+      if ylims is None:                                                   #  in chunks, so memory-mapped columns are never read in whole
+         ylims=column_limits(self.yvalues)
+      assert None not in xlims and None not in ylims,'Empty data need explicit xlims and ylims'
+      self.set_xlimit(*xlims)
+      self.set_ylimit(*ylims)
       self.set_densitymap_resolution(0.01)                                # Set the densitymap resolution to a default value
       self.set_histogram_resolution(0.02)                                 # Set the histogram resolution to a default value
       self.plot_pearson=False                                             # Don't show Pearson Coefficient by default
+      self.reset_maps()                                                   # Blank maps and sums, ready for add_data on empty data
 
-   def set_densitymap_resolution(self,density):                           # ===Set the densitymap resolution===
+   @classmethod
+   def from_files(cls,xfile,yfile,dtype='float64',xlims=None,ylims=None): # ===Construct from two column files (.npy or flat binary)===
+      return cls((open_column(xfile,dtype),open_column(yfile,dtype)),xlims,ylims) # Columns are memory-mapped and streamed, so they
+                                                                          #     can be larger than RAM
+
+   def __getstate__(self):                                                # ===Pickle without the data columns once they are binned===
+      state=self.__dict__.copy()                                          #    The maps are all that is needed to draw, and pickling
+      if self.is_plotted:                                                 #     a memory-mapped column would copy it whole
+         state['xvalues']=np.zeros(0)
+         state['yvalues']=np.zeros(0)
+      return state
+
+   def set_densitymap_resolution(self,density,ydensity=None):             # ===Set the densitymap resolution===
       self.dens_res=density                                               #    Densitymap resolution = the input value
+      self.dens_res_y=ydensity                                            #    Optional separate resolution for the y-axis
       self.make_ranges('xy')                                              #    Recalculate x and y axis values
+      self.is_plotted=False                                               #    The maps must be re-binned before they are drawn
 
    def set_histogram_resolution(self,density):                            # ===Set the histogram resolution===
       self.hist_res=density                                               #    Histogram resolution = the input value
+      self.is_plotted=False
 
    def show_contour(self):
       self.contour=True
 
+   def show_smoothed(self,bandwidth='scott'):                             # ===Smooth the densitymap and histograms with a Gaussian KDE===
+      self.smoothed=True                                                  #    bandwidth is 'scott', 'silverman', or an (x,y) pair (or
+      self.bandwidth=bandwidth                                            #     one number for both) in data units
+
+   def hide_smoothed(self):                                               # ===Show raw counts again===
+      self.smoothed=False
+
    def set_xlimit(self,xlim_lower,xlim_upper):                            # ===Set the limits on the x-axis===
       self.xlims[0]=xlim_lower                                            #    Fetch lower limit
       self.xlims[1]=xlim_upper                                            #    Fetch upper limit
       self.x_diff=self.xlims[1]-self.xlims[0]                             #    Store difference between limits
       self.make_ranges('x')                                               #    Re-Create x range.
+      self.is_plotted=False
 
    def set_ylimit(self,ylim_lower,ylim_upper):                            # ===Set the limits on the x-axis===
       self.ylims[0]=ylim_lower                                            #    Fetch lower limit
       self.ylims[1]=ylim_upper                                            #    Fetch upper limit
       self.y_diff=self.ylims[1]-self.ylims[0]                             #    Store difference between limits
       self.make_ranges('y')                                               #    Re-Create y range.     
+      self.is_plotted=False
 
    def show_pearson(self):                                                #    Display Pearson Coefficient in the final plot
       self.plot_pearson=True
@@ -143,50 +654,148 @@ class density_chart(chart):                                               # ===T
       if 'x' in xy:                                                       #    Allow selective making of only one range
          self.x_range=np.arange(self.xlims[0],self.xlims[1]+0.1*self.dens_res*self.x_diff,self.dens_res*self.x_diff)
       if 'y' in xy:
-         self.y_range=np.arange(self.ylims[0],self.ylims[1]+0.1*self.dens_res*self.y_diff,self.dens_res*self.y_diff)
+         y_res=self.dens_res if self.dens_res_y is None else self.dens_res_y
+         self.y_range=np.arange(self.ylims[0],self.ylims[1]+0.1*y_res*self.y_diff,y_res*self.y_diff)
 
       # The term 0.1*self.dens_res*self.x_diff forces the range to extend to the upper value, while the 0.1 prevents it going any further
       # which it tends to do, presumably due to floating point error. 
 
+   def use_pyramid(self,base_size=1024):                                  # ===Answer re-limiting and re-binning from a density_pyramid===
+      self.pyramid=density_pyramid(self.xlims,self.ylims,base_size)       #    Covers the limits in force now, normally the data range
+      self.is_plotted=False
+
    def plot(self):                                                        # ===Prepare Plot Data===
-      pixelwidth=int(len(self.x_range))                                   #    Fetch the width, in pixels, of the densitymap
-      self.density_map=np.zeros([pixelwidth,pixelwidth])                  #    Create blank densitymap
-      for datapoint in range(self.num_data):                              #    For each x,y pair in the data...
-         x,y=self.xvalues[datapoint],self.yvalues[datapoint]
-         grid_x=int((x-self.xlims[0])*pixelwidth/self.x_diff)             #    Fetch the corresponding pixel that corresponds with the datapoint
-         grid_y=int((y-self.ylims[0])*pixelwidth/self.y_diff)
-         if grid_x>=0 and grid_x<pixelwidth and grid_y>=0 and grid_y<pixelwidth:
-            self.density_map[grid_y,grid_x]+=1                            #    If pixel is valid, add one to its value
+      if self.pyramid is None or self.pyramid.count!=self.num_data:       #    A pyramid already holding every point saves a pass
+         assert self.num_data==len(self.xvalues),('Points are not kept once streamed with add_data or pickled after plotting, '+
+                                                  'so cannot be re-binned: call use_pyramid() first')
+         timer=self.stage('binning',self.num_data,'points')
+         self.reset_maps()                                                #    Start from a blank densitymap
+         self.accumulate(self.xvalues,self.yvalues,progress=timer.update) #    Bin the stored data
+         timer.finish()
+      if self.pyramid is not None:
+         timer=self.stage('rebin')
+         self.rebin_pyramid()
+         timer.finish()
       self.is_plotted=True                                                #    Let the object know its ready to display
 
+   def add_data(self,x,y):                                                # ===Add a chunk of points to the existing map===
+      assert len(x)==len(y)
+      if not self.is_plotted:                                             #    Make sure the stored data are binned first
+         self.plot()
+      self.accumulate(x,y)                                                #    The chunk is binned but not kept, so data can be
+      self.num_data+=len(x)                                               #     streamed in from disk or a generator.  Re-binning at
+                                                                          #     new limits or resolution then needs use_pyramid()
+      if self.pyramid is not None:
+         self.rebin_pyramid()
+
+   def map_shape(self):                                                   # ===Height and width, in pixels, of the densitymap===
+      pixelwidth=int(len(self.x_range))
+      if self.dens_res_y is None:
+         return pixelwidth,pixelwidth                                     #    Square map unless a y-resolution was given
+      return int(len(self.y_range)),pixelwidth
+
+   def rebin_pyramid(self):                                               # ===Densitymap and histograms from the pyramid===
+      pixelheight,pixelwidth=self.map_shape()
+      self.density_map,self.x_hist,self.y_hist=self.pyramid.rebin(self.xlims,self.ylims,pixelwidth,pixelheight,int(1/self.hist_res))
+
+   def reset_maps(self):                                                  # ===Blank densitymap, histograms and Pearson sums===
+      pixelheight,pixelwidth=self.map_shape()                             #    Fetch the size, in pixels, of the densitymap
+      self.density_map=np.zeros([pixelheight,pixelwidth])                 #    Create blank densitymap
+      self.x_hist=np.zeros(int(1/self.hist_res))                          #    Create blank marginal histograms
+      self.y_hist=np.zeros(int(1/self.hist_res))
+      self.moments=[0,0.0,0.0,0.0,0.0,0.0]                                #    n, mean x, mean y, sum dx^2, sum dy^2, sum dx*dy
+      if self.pyramid is not None:
+         self.pyramid.clear()
+
+   def accumulate(self,x,y,chunk_size=2**20,progress=None):               # ===Bin points into the densitymap, histograms and Pearson sums===
+      pixelheight,pixelwidth=self.density_map.shape
+      for i in range(0,len(x),chunk_size):                                #    Work in chunks to keep the temporary arrays small
+         xc=np.asarray(x[i:i+chunk_size],dtype=float)
+         yc=np.asarray(y[i:i+chunk_size],dtype=float)
+         if len(xc)==0:
+            continue
+         if self.pyramid is not None:
+            self.pyramid.add(xc,yc)                                       #    The pyramid replaces direct binning
+         else:
+            self.density_map+=bin_points(xc,yc,self.xlims,self.ylims,pixelwidth,pixelheight)
+            self.x_hist+=np.histogram(xc,bins=len(self.x_hist),range=(self.xlims[0],self.xlims[1]))[0]
+            self.y_hist+=np.histogram(yc,bins=len(self.y_hist),range=(self.ylims[0],self.ylims[1]))[0]
+         n_a,mx_a,my_a,sxx_a,syy_a,sxy_a=self.moments                     #    Merge this chunk's moments into the running ones
+         n_b=len(xc)
+         mx_b=xc.mean()
+         my_b=yc.mean()
+         n=n_a+n_b
+         dx=mx_b-mx_a
+         dy=my_b-my_a
+         self.moments=[n,mx_a+dx*n_b/float(n),my_a+dy*n_b/float(n),
+                       sxx_a+np.sum((xc-mx_b)**2)+dx*dx*n_a*n_b/float(n),
+                       syy_a+np.sum((yc-my_b)**2)+dy*dy*n_a*n_b/float(n),
+                       sxy_a+np.sum((xc-mx_b)*(yc-my_b))+dx*dy*n_a*n_b/float(n)]
+         if progress is not None:
+            progress(i+len(xc),len(x))
+
+   def pearson(self):                                                     # ===Pearson coefficient of all points added so far===
+      n,mx,my,sxx,syy,sxy=self.moments
+      return sxy/np.sqrt(sxx*syy)
+
+   def bandwidths(self,dims=2):                                           # ===Kernel bandwidths in data units===
+      if isinstance(self.bandwidth,str):                                #    Rules of thumb for a dims-dimensional Gaussian kernel
+         n,mx,my,sxx,syy,sxy=self.moments
+         factor=float(n)**(-1.0/(dims+4))
+         if self.bandwidth=='silverman':
+            factor*=(4.0/(dims+2))**(1.0/(dims+4))
+         return factor*np.sqrt(sxx/n),factor*np.sqrt(syy/n)
+      if np.ndim(self.bandwidth)==0:
+         return self.bandwidth,self.bandwidth
+      return tuple(self.bandwidth)
+
+   def smoothed_maps(self):                                               # ===Densitymap and histograms as they will be drawn===
+      if not self.smoothed:
+         return self.density_map,self.x_hist,self.y_hist
+      pixelheight,pixelwidth=self.density_map.shape
+      bx,by=self.bandwidths(2)                                            #    Kernel widths converted from data units to bins
+      density_map=gaussian_smooth(self.density_map,[by*pixelheight/self.y_diff,bx*pixelwidth/self.x_diff])
+      hx,hy=self.bandwidths(1)
+      x_hist=gaussian_smooth(self.x_hist,[hx*len(self.x_hist)/self.x_diff])
+      y_hist=gaussian_smooth(self.y_hist,[hy*len(self.y_hist)/self.y_diff])
+      return density_map,x_hist,y_hist
+
    def make_plot(self):                                                   # ===Display/Save Plot===
+      timer=self.stage('render')
+      load_plotting()
       self.fig=pl.figure()                                                #    Create the figure and the grid, noting size ratios of the panels
       gs=gridspec.GridSpec(2, 2, width_ratios=[3,1], height_ratios=[1,3])
-      ax0=pl.subplot(gs[0])                                               #    Assign IDs to the cells in the grid
-      ax1=pl.subplot(gs[1])
-      ax2=pl.subplot(gs[2])
-      ax3=pl.subplot(gs[3])
-      ax0.hist(self.xvalues,bins=int(1/self.hist_res),range=(self.xlims[0],self.xlims[1])) # Plot the x-axis histogram
+      ax0=self.fig.add_subplot(gs[0])                                     #    Assign IDs to the cells in the grid
+      ax1=self.fig.add_subplot(gs[1])
+      ax2=self.fig.add_subplot(gs[2])
+      ax3=self.fig.add_subplot(gs[3])
+      density_map,x_hist,y_hist=self.smoothed_maps()                      #    Raw or KDE-smoothed counts
+      hist_edges=np.linspace(self.xlims[0],self.xlims[1],len(x_hist)+1)
+      ax0.hist(hist_edges[:-1],bins=hist_edges,weights=x_hist)            #    Plot the x-axis histogram from the binned counts
       ax0.get_xaxis().set_visible(False)                                  #    Hide both axes on this panel
       ax0.get_yaxis().set_visible(False)
       ax0.set_xlim(self.xlims[0],self.xlims[1])                           #    Set the plot limits
       ax1.axis('off')                                                     #    Hide the top-left panel
       if self.plot_pearson:                                               #    If requested, print the Pearson Correlation Coefficient in the empty panel
-         ax1.text(0.1,0.01,'Pearson Coeff. ='+str(st.pearsonr(self.xvalues,self.yvalues)[0])[:4])
+         ax1.text(0.1,0.01,'Pearson Coeff. ='+str(self.pearson())[:4])
       if not self.contour:
-         ax2.pcolor(self.x_range,self.y_range,self.density_map,cmap=self.colormap) # Plot the densitymap
+         x_edges=np.linspace(self.xlims[0],self.xlims[1],density_map.shape[1]+1) # Pixel edges as used when binning
+         y_edges=np.linspace(self.ylims[0],self.ylims[1],density_map.shape[0]+1)
+         draw_map(ax2,density_map,self.renderer,self.colormap,x_edges,y_edges) # Plot the densitymap
       else:
-         ax2.contour(self.x_range,self.y_range,self.density_map)
+         ax2.contour(self.x_range,self.y_range,density_map)
       ax2.set_xlabel(self.xlabel)                                         #    Place labels
       ax2.set_ylabel(self.ylabel)
       ax2.set_ylim(self.ylims[0],self.ylims[1])                           #    Set both limits for this panel
       ax2.set_xlim(self.xlims[0],self.xlims[1])
-      ax3.hist(self.yvalues,bins=int(1/self.hist_res),range=(self.ylims[0],self.ylims[1]),orientation='horizontal') # Plot the y-axis histogram
+      hist_edges=np.linspace(self.ylims[0],self.ylims[1],len(y_hist)+1)
+      ax3.hist(hist_edges[:-1],bins=hist_edges,weights=y_hist,orientation='horizontal') # Plot the y-axis histogram
       ax3.get_xaxis().set_visible(False)                                  #    Hide both axes on this panel
       ax3.get_yaxis().set_visible(False)
       ax3.set_ylim(self.ylims[0],self.ylims[1])                           #    Set the plot limits 
       self.fig.subplots_adjust(hspace=0)                                  #    Remove the whitespace between panels
       self.fig.subplots_adjust(wspace=0)
+      timer.finish()
 
 
 
@@ -199,9 +808,17 @@ class lightcurve_ls(chart):                                               # ===T
 
     chart.set_window_size(x)
     chart.set_timestep(x)
+    chart.set_incremental(x,refresh=64)
+    chart.set_workers(x)
+    chart.set_periodogram(x)
+    chart.set_cache(x,max_bytes=2**30)
+    chart.unset_cache()
     chart.set_freqstep(x)
     chart.set_flimit(x,y)
     chart.set_colormap(x)
+    chart.set_renderer(x)
+    chart.set_decimate(x)
+    chart.set_progress(x)
     chart.set_xlabel(x)
     chart.set_ylabel(x)
     chart.set_ylabel2(x)
@@ -209,6 +826,7 @@ class lightcurve_ls(chart):                                               # ===T
     chart.plot()
     chart.show()
     chart.show_Inu(lag=0)
+    chart.lag_scan(lags=None,histograms=False,bins=100)
     chart.save()
 
    '''
@@ -216,6 +834,14 @@ class lightcurve_ls(chart):                                               # ===T
    def __init__(self,times,counts,errors):                                #    Must provide 3  1-dimensional datasets to the object, corresponding to times,
                                                                           #     values and errors.
 
+      self.times=np.array(times)                                          #    Save data
+      self.counts=np.array(counts)
+      self.errors=np.array(errors)
+
+      self.setup(self.times[1]-self.times[0])                             #    Fetch the data binning and set up defaults
+
+   def setup(self,time_binning):                                          # ===Default settings for a given data binning===
+
       self.startup()                                                      #    Basic initialisation
 
       self.freq_stp_size=0.001                                            #    Setup frequency stepsize
@@ -225,11 +851,7 @@ class lightcurve_ls(chart):                                               # ===T
 
       self.ylabel2=''
 
-      self.times=np.array(times)                                          #    Save data
-      self.counts=np.array(counts)
-      self.errors=np.array(errors)
-
-      self.time_binning=self.times[1]-self.times[0]                       #    Fetch the data binning
+      self.time_binning=time_binning
 
       self.win_size=int(31.25/self.time_binning)                          #    Default 31.25s windows
       self.time_stp_size=int(1.25/self.time_binning)                      #    Default 1.25s slide between windows
@@ -237,6 +859,11 @@ class lightcurve_ls(chart):                                               # ===T
       self.plot_maxfreqs=False
       self.plot_lc=True
       self.contours=False
+      self.incremental=False                                              #    Compute every window from scratch by default
+      self.refresh=64
+      self.workers=1                                                      #    Serial by default
+      self.cache=None                                                     #    No on-disk spectrogram cache by default
+      self.periodogram='native'                                           #    Built-in batched Lomb-Scargle
 
    def make_freq_array(self):                                             # ===Construct frequency array===
       self.freqs=np.arange(self.freq_low_lim,self.freq_upp_lim,self.freq_stp_size)
@@ -265,6 +892,28 @@ class lightcurve_ls(chart):                                               # ===T
    def set_timestep(self,timestep):                                       # ===Setter for time stepsize===
       self.time_stp_size=int(timestep/self.time_binning)
 
+   def set_incremental(self,incremental=True,refresh=64):                 # ===Toggle incremental sliding-window spectrogram===
+      self.incremental=incremental                                        #    Reuse the sums shared by overlapping windows
+      self.refresh=refresh                                                #    Recompute the sums from scratch every refresh windows
+
+   def set_workers(self,workers):                                         # ===Setter for number of worker processes===
+      self.workers=workers
+
+   def set_periodogram(self,periodogram):                                 # ===Choose the periodogram backend===
+      assert callable(periodogram) or periodogram in periodograms         #    A registered name, or any function taking
+      self.periodogram=periodogram                                        #     (times,counts,errors,freqs), kept by this chart only
+
+   def periodogram_function(self):                                        # ===The chosen periodogram as a function===
+      if callable(self.periodogram):
+         return self.periodogram
+      return periodograms[self.periodogram]
+
+   def set_cache(self,directory,max_bytes=2**30):                         # ===Keep spectrograms in an on-disk cache===
+      self.cache=spectrogram_cache(directory,max_bytes)
+
+   def unset_cache(self):                                                 # ===Stop using the on-disk cache===
+      self.cache=None
+
    def set_freqstep(self,freqstep):                                       # ===Setter for frequency step size===
       self.freq_stp_size=freqstep
       self.make_freq_array()                                              #    Reconstruct the frequency array
@@ -274,30 +923,53 @@ class lightcurve_ls(chart):                                               # ===T
       self.freq_upp_lim=f_high                                            #    Set upper frequency limit
       self.make_freq_array()                                              #    Reconstruct the frequency array
 
-   def plot(self):                                                        # ===Prepare Plot Data===
-      spectrogram=[]                                                      #    Setup blank list to append spectra into
-      lcurve=[]                                                           #    Setup blank list to append mean values into
-      maxfreqs=[]
-      prog=None                                                           #    Token needed to print % completion to screen
-      for i in range(len(self.times)-self.win_size)[::self.time_stp_size]:
-         prog2=(i*10)/(len(self.times)-self.win_size)
-         if prog2!=prog:
-            print 'Plotting:',prog2*10,'%'                                #    Print % complete every 10%
-            prog=prog2
-         spectrum=pan.lomb_scargle(self.times[i:i+self.win_size],self.counts[i:i+self.win_size],self.errors[i:i+self.win_size],self.freqs)
-         spectrogram.append(spectrum)
-         maxfreqs.append(self.freqs[np.argmax(spectrum)])
-         lcurve.append(np.mean(self.counts[i:i+self.win_size]))           #    Append spectrum and average value
-      self.spectrogram=(np.array(spectrogram)/1000.0).transpose()         #    Transpose spectrum/time matrix
-      self.lcurve=np.array(lcurve)
-      self.maxfreqs=np.array(maxfreqs)
-      self.taxis=self.times[:(len(self.times)-self.win_size)][::self.time_stp_size] # Setup the time axis
+   def plot(self,workers=None):                                           # ===Prepare Plot Data===
+      if workers is None:
+         workers=self.workers
+      n_times=len(self.times)
+      entry=None
+      cached=self.cache is not None and not callable(self.periodogram)    #    Unregistered functions have no name to key the cache on
+      if cached:                                                          #    Reuse a stored spectrogram of the same data and settings
+         timer=self.stage('cache')
+         key=self.cache.key(self.times,self.counts,self.errors,self.win_size,self.time_stp_size,self.freqs,self.periodogram)
+         entry=self.cache.load(key)
+         timer.finish()
+      if entry is not None:
+         spectrogram=entry['spectrogram']
+         self.maxfreqs=entry['maxfreqs']
+         self.lcurve=entry['lcurve']
+      else:
+         timer=self.stage('spectrogram')                                  #    Progress in windows, so the rate is windows per second
+         report=timer.update
+         t_win=window_view(self.times,self.win_size,self.time_stp_size)   #    Every window as a row of a 2D (strided, uncopied) batch
+         c_win=window_view(self.counts,self.win_size,self.time_stp_size)
+         e_win=window_view(self.errors,self.win_size,self.time_stp_size)
+         if self.periodogram!='native':                                   #    Other backends are called one window at a time
+            spectrogram=periodogram_loop(self.periodogram_function(),t_win,c_win,e_win,self.freqs,progress=report)
+         elif workers>1:
+            spectrogram=lomb_scargle_parallel(self.times,self.counts,self.errors,self.freqs,self.win_size,self.time_stp_size,
+                                              workers,incremental=self.incremental,refresh=self.refresh,progress=report)
+         elif self.incremental:
+            spectrogram=lomb_scargle_sliding(self.times,self.counts,self.errors,self.freqs,self.win_size,self.time_stp_size,
+                                             refresh=self.refresh,progress=report)
+         else:
+            spectrogram=lomb_scargle_batch(t_win,c_win,e_win,self.freqs,progress=report)
+         self.maxfreqs=self.freqs[np.argmax(spectrogram,axis=1)]
+         self.lcurve=c_win.mean(axis=1)                                   #    Average value of each window
+         timer.finish(len(spectrogram))
+         if cached:
+            self.cache.store(key,spectrogram=spectrogram,maxfreqs=self.maxfreqs,lcurve=self.lcurve)
+      self.spectrogram=(spectrogram/1000.0).transpose()                   #    Transpose spectrum/time matrix
+      self.taxis=self.times[:(n_times-self.win_size)][::self.time_stp_size] # Setup the time axis
       self.is_plotted=True                                                #    Let object know it is plotted
 
    def make_plot(self):                                                   # ===Display/Save Plots===
+      timer=self.stage('render')
+      load_plotting()
       self.fig=pl.figure()                                                #    Create the figure object
       ax1=self.fig.add_axes([0.1,0.1,0.65,0.8])                           #    Create the spectrogram axes
-      pc=ax1.pcolor(self.taxis,self.freqs,self.spectrogram,cmap=self.colormap) #    Plot spectrogram
+      pc=draw_map(ax1,self.spectrogram,self.renderer,self.colormap,
+                  centre_edges(self.taxis),centre_edges(self.freqs))      #    Plot spectrogram, cells centred on each window and frequency
       ax1.set_xlabel(self.xlabel)                                         #    Set global x-label
       ax1.set_ylim(self.freqs[0],self.freqs[-1])                          #    Set y-limits of spectrogram
       ax1.set_ylabel(self.ylabel)                                         #    Set y-label of spectrogram
@@ -306,24 +978,62 @@ class lightcurve_ls(chart):                                               # ===T
       cbar.set_label(self.zlabel+' (*1000)', rotation=270,labelpad=15)    #    Set z-label
       ax2 = ax1.twinx()                                                   #    Create the lightcurve axes
       ax2.set_xlim(self.taxis[0],self.taxis[-1])                          #    Set global x-limits
+      t_lc,lc=self.taxis,self.lcurve
+      t_mf,mf=self.taxis,self.maxfreqs
+      if self.decimate:                                                   #    Keep the min and max of each pixel column only
+         n_pixels=int(self.fig.get_figwidth()*self.fig.dpi*0.65)
+         t_lc,lc=decimate(self.taxis,self.lcurve,n_pixels)
+         t_mf,mf=decimate(self.taxis,self.maxfreqs,n_pixels)
       leg_key=[]
       blue_patch = mpatches.Patch(color='blue', label='Count Rate')       #    Create object to represent the lightcurve in the key
       black_patch = mpatches.Patch(color='black', label='Peak Frequency') #    Create object to represent the lightcurve in the key
       if self.plot_lc:
          ax2.yaxis.tick_right()                                           #    Force the lightcurve y-axis to the right
          ax2.yaxis.set_label_position('right')                            #    Push the label over there too
-         ax2.plot(self.taxis,self.lcurve,'b')                             #    Plot the lightcurve
+         ax2.plot(t_lc,lc,'b')                                            #    Plot the lightcurve
          ax2.set_ylim(0,max(self.lcurve)*1.1)                             #    Set y-limits of lightcurve
          ax2.set_ylabel(self.ylabel2,rotation=-90,labelpad=15)            #    Set y-label of lightcurve
          leg_key.append(blue_patch)
       else:
          ax2.set_yticks([],[])
       if self.plot_maxfreqs:
-         ax2.plot(self.taxis,((self.maxfreqs-self.freqs[0])*max(self.lcurve)*1.1/self.freqs[-1]),'k')
+         ax2.plot(t_mf,((mf-self.freqs[0])*max(self.lcurve)*1.1/self.freqs[-1]),'k')
 
          leg_key.append(black_patch)
       if leg_key!=[]:
-         pl.legend(handles=leg_key)
+         ax2.legend(handles=leg_key)
+      timer.finish()
+
+   def lag_scan(self,lags=None,histograms=False,bins=100):                # ===Pearson coefficient of intensity and peak frequency against lag===
+      assert lags is not None or not histograms,'Give explicit lags with histograms=True: each lag needs a bins*bins map'
+      if not self.is_plotted:                                             #    Nothing is drawn.  lags are in seconds and are
+         self.plot()                                                      #     truncated to whole time steps, as in show_Inu; by
+      step=self.time_binning*self.time_stp_size                           #     default every step with at least half overlap
+      n=len(self.lcurve)
+      if lags is None:
+         shifts=np.arange(-(n//2),n//2+1)
+      else:
+         shifts=(np.asarray(lags,dtype=float)/step).astype(int)
+         assert np.all(np.abs(shifts)<n)
+      lags=shifts*step
+      pearson=lagged_pearson(self.lcurve,self.maxfreqs,shifts)
+      best_lag=lags[np.nanargmax(np.abs(pearson))]                        #    Strongest correlation or anticorrelation
+      if not histograms:
+         return lags,pearson,best_lag
+      xlims=column_limits(self.lcurve)                                    #    One set of bins, shared by every lag
+      ylims=column_limits(self.maxfreqs)
+      x_span=float(xlims[1]-xlims[0]) or 1.0                              #    A constant column all falls in the first bin
+      y_span=float(ylims[1]-ylims[0]) or 1.0
+      grid_x=np.minimum(((self.lcurve-xlims[0])*bins/x_span).astype(int),bins-1)
+      grid_y=np.minimum(((self.maxfreqs-ylims[0])*bins/y_span).astype(int),bins-1)
+      maps=np.empty((len(shifts),bins,bins),dtype=np.int32)               #    Counts, kept compact as there is one map per lag
+      for i,k in enumerate(shifts):                                       #    One bincount per lag, [lag,y,x] like density_map
+         if k>=0:
+            pixel=grid_y[:n-k]*bins+grid_x[k:]
+         else:
+            pixel=grid_y[-k:]*bins+grid_x[:n+k]
+         maps[i]=np.bincount(pixel,minlength=bins*bins).reshape(bins,bins)
+      return lags,pearson,best_lag,maps
 
    def show_Inu(self,lag=0):                                              #    Feature to quickly construct a 2D histogram of peak frequency against intensity
       if not self.is_plotted:
@@ -353,4 +1063,141 @@ class lightcurve_ls(chart):                                               # ===T
       den_chart.plot()
       den_chart.show()
 
-      
+
+
+
+class lightcurve_stream(lightcurve_ls):                                   # ===The streaming Lightcurve_LS object===
+
+   '''Streaming Lightcurve/LombScargle Chart.
+
+   Samples are fed in chunks with append(), e.g. from a generator via consume().  Each window the new samples complete is
+   transformed at once, and its spectrum (as float32), mean count rate and peak frequency go into ring buffers holding the
+   last history windows.  Only the samples still needed by unfinished windows are kept, so the work per chunk depends on the
+   chunk size and memory stays fixed however long the run lasts.  A window is emitted once the sample after its last one
+   has arrived, so the windows are exactly those lightcurve_ls makes from the same data, which leaves out a final window
+   ending on the last sample.  Window, timestep, frequency and periodogram settings must be chosen before the first append.
+   plot() reads the ring buffers, so show(), save(), show_Inu() and lag_scan() work at any point in the run.
+
+   Available actions:
+
+    chart.append(times,counts,errors)
+    chart.consume(chunks)
+    chart.reset()
+    chart.set_history(x)
+    ...and all the lightcurve_ls actions
+
+   '''
+
+   def __init__(self,time_binning,history=20000):                         #    Must provide the time binning of the samples to come
+      self.setup(time_binning)
+      self.history=history
+      self.reset()
+
+   def set_history(self,history):                                         # ===Setter for number of windows kept (clears the stream)===
+      self.history=history
+      self.reset()
+
+   def reset(self):                                                       # ===Forget all samples and windows===
+      self.buffer=np.zeros((3,0))                                         #    Times, counts and errors not yet used up by windows
+      self.skip=0                                                         #    Samples still to discard when the timestep exceeds the window
+      self.n_columns=0                                                    #    Windows produced so far
+      self.ring_spec=None                                                 #    Ring buffers are made on the first append
+      self.is_plotted=False
+
+   def append(self,times,counts,errors):                                  # ===Add samples; returns the windows they complete===
+      timer=self.stage('append')
+      chunk=np.array([times,counts,errors],dtype=float).reshape(3,-1)[:,self.skip:]
+      self.skip-=min(self.skip,len(times))
+      self.buffer=np.concatenate([self.buffer,chunk],axis=1)
+      t_win=window_view(self.buffer[0],self.win_size,self.time_stp_size)  #    The buffer always starts at the next window
+      c_win=window_view(self.buffer[1],self.win_size,self.time_stp_size)
+      e_win=window_view(self.buffer[2],self.win_size,self.time_stp_size)
+      if self.periodogram!='native':
+         spectra=periodogram_loop(self.periodogram_function(),t_win,c_win,e_win,self.freqs)
+      else:
+         spectra=lomb_scargle_batch(t_win,c_win,e_win,self.freqs)
+      n_new=len(spectra)
+      taxis=t_win[:,0].copy()
+      lcurve=c_win.mean(axis=1)
+      maxfreqs=self.freqs[np.argmax(spectra,axis=1)] if n_new else np.zeros(0)
+      used=n_new*self.time_stp_size                                       #    Drop the samples no later window needs
+      self.skip+=max(used-self.buffer.shape[1],0)
+      self.buffer=self.buffer[:,used:].copy()
+      self.store(taxis,spectra,lcurve,maxfreqs)
+      timer.finish(n_new)
+      return taxis,spectra,lcurve,maxfreqs
+
+   def consume(self,chunks):                                              # ===Append (times,counts,errors) chunks from any iterable===
+      for times,counts,errors in chunks:                                  #    Yields each append's new windows as they are made
+         yield self.append(times,counts,errors)
+
+   def store(self,taxis,spectra,lcurve,maxfreqs):                         # ===Write new windows into the ring buffers===
+      if self.ring_spec is None:
+         self.ring_spec=np.zeros((self.history,len(self.freqs)),dtype=np.float32)
+         self.ring_taxis=np.zeros(self.history)
+         self.ring_lcurve=np.zeros(self.history)
+         self.ring_maxfreqs=np.zeros(self.history)
+      n_new=len(spectra)
+      keep=min(n_new,self.history)                                        #    More windows than the buffer holds: keep the newest
+      slots=(self.n_columns+np.arange(n_new-keep,n_new))%self.history
+      self.ring_spec[slots]=spectra[n_new-keep:]
+      self.ring_taxis[slots]=taxis[n_new-keep:]
+      self.ring_lcurve[slots]=lcurve[n_new-keep:]
+      self.ring_maxfreqs[slots]=maxfreqs[n_new-keep:]
+      self.n_columns+=n_new
+      if n_new:
+         self.is_plotted=False                                            #    The next show()/save() picks up the new windows
+
+   def plot(self):                                                        # ===Prepare Plot Data from the ring buffers===
+      n=min(self.n_columns,self.history)
+      assert n>0,'No complete windows yet'
+      order=(self.n_columns-n+np.arange(n))%self.history                  #    Oldest window first
+      self.spectrogram=(self.ring_spec[order]/1000.0).transpose()
+      self.taxis=self.ring_taxis[order]
+      self.lcurve=self.ring_lcurve[order]
+      self.maxfreqs=self.ring_maxfreqs[order]
+      self.is_plotted=True
+
+
+def save_chart(job):                                                      # ===Render one chart to file (batch task)===
+   chart,filename=job
+   if mp.current_process().daemon and isinstance(chart,lightcurve_ls):
+      chart.set_workers(1)                                                #    Pool workers cannot start pools of their own; this is
+                                                                          #     the worker's copy, so the caller's chart is unchanged
+   chart.save(filename)                                                   #    save() closes the figure once it is written
+   return filename
+
+def init_headless():                                                      # ===Pool initialiser: draw without a display===
+   load_plotting()
+   pl.switch_backend('Agg')
+
+def render_batch(charts,filenames,workers=1,maxtasks=100): # ===Render many charts to files on a non-interactive backend===
+
+   # Anything with a save(filename) method can be rendered: density_chart, lightcurve_ls or StatObjects.statrange.  Each
+   # figure is closed and released as soon as it is written, so memory stays flat however many charts there are.  With
+   # workers>1 the charts are sent to a pool of processes, each of which is replaced after maxtasks charts; output order
+   # follows input.  Switching pyplot's backend closes every open figure, so with workers=1 the charts are drawn in this
+   # process only if it is already on Agg or has no figures open; otherwise a single worker process draws them, and the
+   # caller's figures are left alone.  Unplotted density_charts are binned here before going to a pool, so that only their
+   # maps are pickled and memory-mapped columns are never copied.
+
+   jobs=list(zip(charts,filenames))
+   load_plotting()
+   if workers<=1 and pl.get_backend().lower()=='agg':
+      return [save_chart(job) for job in jobs]
+   if workers<=1 and not pl.get_fignums():                                #    Nothing to lose by switching backend
+      backend=pl.get_backend()
+      pl.switch_backend('Agg')
+      try:
+         return [save_chart(job) for job in jobs]
+      finally:
+         pl.switch_backend(backend)                                       #    Put the caller's backend back
+   for chart in charts:
+      if isinstance(chart,density_chart) and not chart.is_plotted:
+         chart.plot()
+   pool=mp.Pool(max(workers,1),initializer=init_headless,maxtasksperchild=maxtasks)
+   try:
+      return pool.map(save_chart,jobs,chunksize=1)
+   finally:
+      pool.close()
+      pool.join()
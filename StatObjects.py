@@ -5,43 +5,196 @@ import warnings
 warnings.simplefilter("ignore")
 
 import numpy as np
-import pylab as pl
+import Timing
+
+pl=None
+
+def load_plotting():
+   global pl
+   if pl is None:
+      import pylab
+      pl=pylab
+
+def percentiles(data,pcts,weights=None,max_partition=16):
+
+   # Linearly interpolated percentiles (numpy's 'linear' definition) of data, which is never modified.  When only a few
+   # percentiles are needed the bracketing order statistics are found by partitioning, O(n) each, rather than a full sort.
+   # With weights, each sample sits at the midpoint of its share of the cumulative weight, scaled so that equal weights
+   # give the same answer as the unweighted case.
+
+   data=np.asarray(data,dtype=float).ravel()
+   pcts=np.asarray(pcts,dtype=float)
+   q=np.clip(pcts/100.0,0,1)
+   if weights is not None:
+      weights=np.asarray(weights,dtype=float).ravel()
+      keep=weights>0
+      data=data[keep]
+      weights=weights[keep]
+      order=np.argsort(data,kind='mergesort')
+      data=data[order]
+      weights=weights[order]
+      cum=np.cumsum(weights)-weights/2-weights[0]/2
+      span=cum[-1]
+      if span<=0:
+         return np.full(q.shape,data[0])
+      return np.interp(q,cum/span,data)
+   pos=q*(len(data)-1)
+   lower=np.floor(pos).astype(int)
+   upper=np.ceil(pos).astype(int)
+   kth=np.unique(np.concatenate([lower.ravel(),upper.ravel()]))
+   if len(kth)<=max_partition:
+      ordered=np.partition(data,kth)
+   else:
+      ordered=np.sort(data)
+   frac=pos-lower
+   return ordered[lower]+(ordered[upper]-ordered[lower])*frac
 
 class statrange():
 
-   def __init__(self,data):
-      data.sort()
-      self.data=data
+   def __init__(self,data,weights=None):
+      self.data=np.asarray(data)
+      self.weights=weights
       self.len=len(data)
       self.is_llim=False
       self.is_ulim=False
+      self.progress=None
+      self.timings={}
+
+   def set_progress(self,callback):
+      self.progress=callback
+
+   def stage(self,name,total=None,unit='points'):
+      return Timing.stage(name,self.progress,self.timings,total,unit)
+
+   def percentiles(self,pcts):
+      timer=self.stage('percentiles')
+      result=percentiles(self.data,pcts,self.weights)
+      timer.finish(self.len)
+      return result
 
    def low(self,pct):
-      pct=int(pct*self.len/100.0)
       self.is_llim=True
-      self.llim=self.data[pct]
-      return self.data[pct]
+      self.llim=self.percentiles(pct)[()]
+      return self.llim
 
    def high(self,pct):
-      pct=int(((100.0-pct)*self.len)/100.0)
       self.is_ulim=True
-      self.ulim=self.data[pct]
-      return self.data[pct]
+      self.ulim=self.percentiles(100.0-pct)[()]
+      return self.ulim
 
    def range(self,low_pct,high_pct):
-      return self.low(low_pct),self.high(high_pct)
+      self.is_llim=True
+      self.is_ulim=True
+      self.llim,self.ulim=self.percentiles([low_pct,100.0-high_pct])
+      return self.llim,self.ulim
 
    def eqrange(self,pct):
       return self.range(pct,pct)
 
-   def plot(self):
-      pl.close()
-      pl.figure()
-      h=max(pl.hist(np.array(self.data),bins=100,color='0.5',linewidth=0)[0])
-      print h
+   def draw_hist(self,ax):
+      timer=self.stage('histogram')
+      h=max(ax.hist(np.array(self.data),bins=100,color='0.5',linewidth=0)[0])
+      timer.finish(self.len)
+      return h
+
+   def make_plot(self):
+      timer=self.stage('render')
+      load_plotting()
+      self.fig=pl.figure()
+      ax=self.fig.add_subplot(111)
+      h=self.draw_hist(ax)
       if self.is_ulim:
-         pl.plot([self.ulim,self.ulim],[0,h*1.1],'b')
+         ax.plot([self.ulim,self.ulim],[0,h*1.1],'b')
       if self.is_llim:
-         pl.plot([self.llim,self.llim],[0,h*1.1],'r')
-      pl.ylim(0,h*1.1)
-      pl.show()
+         ax.plot([self.llim,self.llim],[0,h*1.1],'r')
+      ax.set_ylim(0,h*1.1)
+      timer.finish()
+
+   def plot(self):
+      self.make_plot()
+      self.fig.show()
+
+   def save(self,savename):
+      self.make_plot()
+      timer=self.stage('save')
+      self.fig.savefig(savename)
+      pl.close(self.fig)
+      self.fig=None
+      timer.finish()
+
+class sketch_statrange(statrange):
+
+   # A statrange for data too large to hold, or spread over several machines.  Points are summarised in a merging t-digest:
+   # sorted centroids (mean, weight) whose sizes are limited by the k1 scale function k(q)=compression/(2*pi)*asin(2q-1), so
+   # that each centroid spans at most one unit of k.  A percentile is interpolated between neighbouring centroids with the
+   # same engine statrange uses, so its rank error is at most the quantile span of those centroids, about
+   # 2*pi/compression*sqrt(q*(1-q)).  At the default compression of 500 that is 0.63 percentage points at the median and
+   # 0.13 at the 1st/99th percentile; typical errors are much smaller.  The minimum and maximum are kept exactly.  Memory is
+   # O(compression) whatever the number of points, and merged sketches obey the same bound.
+
+   def __init__(self,data=None,weights=None,compression=500):
+      self.compression=float(compression)
+      self.means=np.zeros(0)
+      self.weights=np.zeros(0)
+      self.len=0
+      self.is_llim=False
+      self.is_ulim=False
+      self.progress=None
+      self.timings={}
+      if data is not None:
+         self.update(data,weights)
+
+   def update(self,chunk,weights=None):
+      chunk=np.asarray(chunk,dtype=float).ravel()
+      if weights is None:
+         weights=np.ones(len(chunk))
+      weights=np.asarray(weights,dtype=float).ravel()
+      self.len+=len(chunk)
+      self.compress(np.concatenate([self.means,chunk]),np.concatenate([self.weights,weights]))
+
+   def merge(self,other):
+      self.len+=other.len
+      self.compress(np.concatenate([self.means,other.means]),np.concatenate([self.weights,other.weights]))
+
+   def compress(self,means,weights):
+      keep=weights>0
+      means=means[keep]
+      weights=weights[keep]
+      order=np.argsort(means,kind='mergesort')
+      means=means[order]
+      weights=weights[order]
+      if len(means)==0:
+         self.means,self.weights=means,weights
+         return
+      cum=np.cumsum(weights)
+      q=(cum-weights/2)/cum[-1]
+      k=self.compression/(2*np.pi)*np.arcsin(2*q-1)
+      group=np.floor(k).astype(int)
+      if len(group)>1:
+         group[0]=group[1]-1
+         group[-1]=group[-2]+1
+      group=np.unique(group,return_inverse=True)[1]
+      new_weights=np.bincount(group,weights)
+      self.means=np.bincount(group,weights*means)/new_weights
+      self.weights=new_weights
+
+   def percentiles(self,pcts):
+      return percentiles(self.means,pcts,self.weights)
+
+   def serialize(self):
+      header=np.array([self.compression,self.len,len(self.means)],dtype=float)
+      return np.concatenate([header,self.means,self.weights]).tobytes()
+
+   def draw_hist(self,ax):
+      bins=np.linspace(self.means[0],self.means[-1],101)
+      return max(ax.hist(self.means,bins=bins,weights=self.weights,color='0.5',linewidth=0)[0])
+
+def deserialize(string):
+   values=np.frombuffer(string,dtype=float)
+   compression,length,n=values[:3]
+   n=int(n)
+   sketch=sketch_statrange(compression=compression)
+   sketch.len=int(length)
+   sketch.means=values[3:3+n].copy()
+   sketch.weights=values[3+n:3+2*n].copy()
+   return sketch
@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+
+import time
+
+try:
+   import resource
+except ImportError:                                                       # Not available on Windows, where peak memory is not reported
+   resource=None
+
+def peak_memory():                                                        # ===Peak resident memory of this process in MB, or None===
+   if resource is None:
+      return None
+   return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0       #    ru_maxrss is in kB on Linux
+
+class stage():                                                            # ===Wall time, rate and peak memory of one stage of work===
+
+   '''Stage Timer.
+
+   Started when made, with update(done,total) called as work proceeds and finish() at the end.  If a callback is given it
+   is called after every update and at the finish with a dict:
+
+    stage     name of the stage, e.g. 'spectrogram', 'binning', 'render'
+    done      units of work done so far, total (or None) in all, and unit their name ('windows', 'points'...)
+    elapsed   wall time in seconds since the stage started
+    rate      done/elapsed, e.g. windows per second, or None
+    peak_mb   peak resident memory of the process in MB, or None
+    finished  True for the call made by finish()
+
+   At the finish the elapsed time is also stored under the stage name in the timings dict, if one is given.
+
+   '''
+
+   def __init__(self,name,callback=None,timings=None,total=None,unit='windows'):
+      self.name=name
+      self.callback=callback
+      self.timings=timings
+      self.total=total
+      self.unit=unit
+      self.done=0
+      self.start=time.time()
+
+   def info(self,finished):
+      elapsed=time.time()-self.start
+      return {'stage':self.name,'done':self.done,'total':self.total,'unit':self.unit,'elapsed':elapsed,
+              'rate':self.done/elapsed if elapsed>0 else None,'peak_mb':peak_memory(),'finished':finished}
+
+   def update(self,done,total=None):                                      # Same signature as the progress arguments in PlotObjects
+      self.done=done
+      if total is not None:
+         self.total=total
+      if self.callback is not None:
+         self.callback(self.info(False))
+
+   def finish(self,done=None):
+      if done is not None:
+         self.done=done
+      info=self.info(True)
+      if self.timings is not None:
+         self.timings[self.name]=info['elapsed']
+      if self.callback is not None:
+         self.callback(info)
+      return info
+
+class print_progress():                                                   # ===Callback that prints progress every 10% and a summary per stage===
+
+   def __init__(self):
+      self.last={}
+
+   def __call__(self,info):
+      if info['finished']:
+         line='%s: %.3f s'%(info['stage'],info['elapsed'])
+         if info['done'] and info['rate'] is not None:
+            line+=', %.0f %s/s'%(info['rate'],info['unit'])
+         if info['peak_mb'] is not None:
+            line+=', %.1f MB peak'%info['peak_mb']
+         print line
+         self.last.pop(info['stage'],None)
+      elif info['total']:
+         tenth=(info['done']*10)//info['total']
+         if tenth!=self.last.get(info['stage']):
+            print '%s: %d %%'%(info['stage'],tenth*10)
+            self.last[info['stage']]=tenth